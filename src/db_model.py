@@ -1,6 +1,8 @@
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.sql import func
 from dotenv import load_dotenv
 import os
 import datetime
@@ -9,18 +11,79 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
-AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+_url = make_url(DATABASE_URL)
+_connect_args = {}
+if _url.get_backend_name() == "postgresql":
+    # Always use the asyncpg driver, and let it keep prepared statements for
+    # the handful of parameterized queries db_tool issues on every turn
+    _url = _url.set(drivername="postgresql+asyncpg")
+    _connect_args = {
+        "prepared_statement_cache_size": 256,
+        "statement_cache_size": 256,
+    }
+
+_pool_args = {}
+if not (_url.get_backend_name() == "sqlite" and _url.database in (None, "", ":memory:")):
+    # In-memory SQLite runs on a StaticPool, which takes no sizing arguments.
+    # Elsewhere allow up to 40 connections before callers queue, and wait at
+    # most 30s for one.
+    _pool_args = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "20")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": 30,
+    }
+
+engine = create_async_engine(
+    _url,
+    echo=False,
+    future=True,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args=_connect_args,
+    **_pool_args,
+)
+
+if _url.get_backend_name() == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """Tune every new SQLite connection for concurrent reads."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-64000")
+        cursor.execute("PRAGMA temp_store=memory")
+        cursor.close()
+
+# The helpers are read-heavy and write through explicit INSERTs, so skip the
+# implicit flush before every query
+AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
+
+async def get_session():
+    """Yield one session per request (FastAPI dependency)."""
+    async with AsyncSessionLocal() as session:
+        yield session
 
 Base = declarative_base()
 
+def _utcnow():
+    """Aware UTC timestamp; a naive one would be read as host-local time by asyncpg."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, index=True)
     role = Column(String)
     content = Column(Text)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Stamped client-side as well: tables created before the server default
+    # was added keep their old column definition, and create_all never alters it
+    created_at = Column(DateTime(timezone=True), default=_utcnow, server_default=func.now(), nullable=False)
+
+    # Matches "last n messages for a user"; ascending columns still serve
+    # the DESC ordering via a reverse index scan
+    __table_args__ = (
+        Index("ix_messages_user_created", "user_id", "created_at"),
+    )
 
 class Warranty(Base):
     __tablename__ = "warranties"
@@ -46,7 +109,12 @@ class Order(Base):
     user_id = Column(String, index=True)
     status = Column(String)
     tracking = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), default=_utcnow, server_default=func.now(), nullable=False)
 
     product_id = Column(String, ForeignKey("products.id"), nullable=False)
-    product = relationship("Product", backref="orders")
\ No newline at end of file
+    product = relationship("Product", backref="orders")
+
+    __table_args__ = (
+        Index("ix_orders_user_created", "user_id", "created_at"),
+        Index("ix_orders_orderid_user", "order_id", "user_id"),
+    )
\ No newline at end of file
@@ -1,94 +1,127 @@
 from src.db_model import engine, Base, Order, Product, Warranty, AsyncSessionLocal
+from src.db_tool import get_all_products, get_all_warranties
 import asyncio
 import sqlalchemy
 
+def _create_missing_indexes(sync_conn):
+    """Add indexes declared after a table was first created (create_all skips them)."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
 async def create_tables():
     """Create all database tables."""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
+
+async def clear_tables():
+    """Delete all rows from every table."""
+    async with AsyncSessionLocal() as session:
+        if engine.dialect.name == "postgresql":
+            # One statement instead of row-by-row deletes; ids restart at 1
+            await session.execute(sqlalchemy.text(
+                "TRUNCATE messages, orders, products, warranties RESTART IDENTITY CASCADE"
+            ))
+        else:
+            await session.execute(sqlalchemy.text("DELETE FROM messages"))
+            await session.execute(sqlalchemy.text("DELETE FROM orders"))
+            await session.execute(sqlalchemy.text("DELETE FROM products"))
+            await session.execute(sqlalchemy.text("DELETE FROM warranties"))
+        await session.commit()
 
 async def seed_database():
     """Seed the database with initial data (idempotent)."""
     async with AsyncSessionLocal() as session:
-        res = await session.execute(sqlalchemy.select(Order).limit(1))
-        if res.scalars().first():
+        res = await session.execute(sqlalchemy.select(Order.id).limit(1))
+        if res.scalar() is not None:
             print("Database already seeded.")
             return
 
         print("Seeding database...")
 
-        warranty1 = Warranty(
-            duration_months=24, 
-            terms="Hanya mencakup cacat produksi."
+        res = await session.execute(
+            sqlalchemy.insert(Warranty).returning(Warranty.id, sort_by_parameter_order=True),
+            [
+                {
+                    "duration_months": 24,
+                    "terms": "Hanya mencakup cacat produksi.",
+                },
+                {
+                    "duration_months": 12,
+                    "terms": "Termasuk perlindungan kerusakan tidak disengaja.",
+                },
+            ],
         )
-        warranty2 = Warranty(
-            duration_months=12, 
-            terms="Termasuk perlindungan kerusakan tidak disengaja."
-        )
-        session.add_all([warranty1, warranty2])
-        await session.flush()
+        warranty1_id, warranty2_id = res.scalars().all()
 
         products = [
-            Product(
-                id="P123",
-                name="Headphone Wireless",
-                description="Headphone wireless berkualitas tinggi dengan noise cancellation.",
-                pros="Kualitas suara yang bagus; Nyaman dipakai; Baterai tahan lama",
-                cons="Harga mahal; Case yang besar",
-                warranty_id=warranty1.id,
-            ),
-            Product(
-                id="P234",
-                name="Smartphone X",
-                description="Smartphone generasi terbaru dengan layar OLED dan sistem triple camera.",
-                pros="Kamera sangat bagus; Performa cepat; Desain premium",
-                cons="Harga tinggi; Tidak ada jack headphone",
-                warranty_id=warranty2.id,
-            ),
-            Product(
-                id="P345",
-                name="Gaming Laptop Pro",
-                description="Laptop gaming yang powerful dengan grafis RTX dan layar high refresh.",
-                pros="GPU tingkat atas; SSD cepat; Sistem pendingin yang baik",
-                cons="Berat; Baterai cepat habis",
-                warranty_id=warranty1.id,
-            ),
+            {
+                "id": "P123",
+                "name": "Headphone Wireless",
+                "description": "Headphone wireless berkualitas tinggi dengan noise cancellation.",
+                "pros": "Kualitas suara yang bagus; Nyaman dipakai; Baterai tahan lama",
+                "cons": "Harga mahal; Case yang besar",
+                "warranty_id": warranty1_id,
+            },
+            {
+                "id": "P234",
+                "name": "Smartphone X",
+                "description": "Smartphone generasi terbaru dengan layar OLED dan sistem triple camera.",
+                "pros": "Kamera sangat bagus; Performa cepat; Desain premium",
+                "cons": "Harga tinggi; Tidak ada jack headphone",
+                "warranty_id": warranty2_id,
+            },
+            {
+                "id": "P345",
+                "name": "Gaming Laptop Pro",
+                "description": "Laptop gaming yang powerful dengan grafis RTX dan layar high refresh.",
+                "pros": "GPU tingkat atas; SSD cepat; Sistem pendingin yang baik",
+                "cons": "Berat; Baterai cepat habis",
+                "warranty_id": warranty1_id,
+            },
         ]
-        session.add_all(products)
-        await session.flush()
+        await session.execute(sqlalchemy.insert(Product), products)
 
         orders = [
-            Order(
-                order_id="ORD12345", 
-                user_id="user1", 
-                status="Shipped", 
-                tracking="TRACK123", 
-                product_id="P123"
-            ),
-            Order(
-                order_id="ORD23456", 
-                user_id="user2", 
-                status="Processing", 
-                tracking=None, 
-                product_id="P234"
-            ),
-            Order(
-                order_id="ORD34567", 
-                user_id="user1", 
-                status="Delivered", 
-                tracking="TRACK789", 
-                product_id="P345"
-            ),
+            {
+                "order_id": "ORD12345", 
+                "user_id": "user1", 
+                "status": "Shipped", 
+                "tracking": "TRACK123", 
+                "product_id": "P123",
+            },
+            {
+                "order_id": "ORD23456", 
+                "user_id": "user2", 
+                "status": "Processing", 
+                "tracking": None, 
+                "product_id": "P234",
+            },
+            {
+                "order_id": "ORD34567", 
+                "user_id": "user1", 
+                "status": "Delivered", 
+                "tracking": "TRACK789", 
+                "product_id": "P345",
+            },
         ]
-        session.add_all(orders)
+        await session.execute(sqlalchemy.insert(Order), orders)
 
         await session.commit()
         print("Database seeded successfully with orders, warranties, and products.")
 
+async def warm_caches():
+    """Preload the catalog caches so the first chat turns skip the database."""
+    async with AsyncSessionLocal() as session:
+        await get_all_products(session)
+        await get_all_warranties(session)
+
 async def init_database():
     """Initialize database: create tables and seed data."""
     await create_tables()
     await seed_database()
+    await warm_caches()
 
 if __name__ == "__main__":
     asyncio.run(init_database())
\ No newline at end of file
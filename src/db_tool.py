@@ -1,134 +1,336 @@
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import joinedload
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.db_model import AsyncSessionLocal, Message, Order, Product, Warranty
 import sqlalchemy
+import asyncio
+import collections
+import itertools
 import json
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Catalog data is seeded once and rarely changes, so read-side lookups are
+# served from process-local caches. Entries are (timestamp, value) pairs;
+# the None key holds the full listing.
+CACHE_TTL_SECONDS = 300
+_PRODUCT_CACHE: dict[str | None, tuple[float, dict | list]] = {}
+_WARRANTY_CACHE: dict[str | None, tuple[float, dict | list]] = {}
+
+async def _cached(cache: dict, key, ttl: float, loader):
+    """Return cache[key] while fresh, otherwise await loader() and store the result."""
+    entry = cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < ttl:
+        return entry[1]
+    value = await loader()
+    if value is not None:
+        cache[key] = (time.monotonic(), value)
+    return value
+
+# Lowercased words users commonly use for each catalog item, resolved to a
+# product ID before querying so most lookups are a primary-key hit instead
+# of a leading-wildcard LIKE scan.
+PRODUCT_SYNONYMS = {
+    "headphone": "P123",
+    "headphones": "P123",
+    "earphone": "P123",
+    "wireless": "P123",
+    "hp": "P234",
+    "smartphone": "P234",
+    "ponsel": "P234",
+    "handphone": "P234",
+    "laptop": "P345",
+    "gaming": "P345",
+}
+
+_PID_RE = re.compile(r"^P\d+$")
+
+def resolve_product_id(product_identifier: str):
+    """Map a free-form product reference to a product ID via PRODUCT_SYNONYMS."""
+    for token in re.findall(r"\w+", product_identifier.lower()):
+        product_id = PRODUCT_SYNONYMS.get(token)
+        if product_id:
+            return product_id
+    return None
+
+def invalidate_caches():
+    """Drop all cached data; call after any bulk write to the database."""
+    _PRODUCT_CACHE.clear()
+    _WARRANTY_CACHE.clear()
+    _HISTORY.clear()
+
+# The newest messages per user, oldest first. A user's window is loaded from
+# the database on first touch and then kept current by persist_message, so
+# the per-turn history read never has to query. Windows are kept for at most
+# HISTORY_MAX_USERS users, evicting the least recently active one; by then
+# its queued writes have long been flushed, so a reload sees them.
+HISTORY_WINDOW = 16
+HISTORY_MAX_USERS = 5000
+_HISTORY: collections.OrderedDict[str, collections.deque] = collections.OrderedDict()
+
+def _recent_history(user_id: str):
+    """Return the user's cached window (marking it recently used), or None."""
+    history = _HISTORY.get(user_id)
+    if history is not None:
+        _HISTORY.move_to_end(user_id)
+    return history
+
+async def _load_history(session: AsyncSession, user_id: str):
+    q = await session.execute(
+        sqlalchemy.select(Message.role, Message.content)
+        .where(Message.user_id == user_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(HISTORY_WINDOW)
+    )
+    rows = [{"role": role, "content": content} for role, content in q]
+    rows.reverse()
+    # Another coroutine may have loaded this user while we were querying
+    history = _recent_history(user_id)
+    if history is None:
+        history = _HISTORY[user_id] = collections.deque(rows, maxlen=HISTORY_WINDOW)
+        if len(_HISTORY) > HISTORY_MAX_USERS:
+            _HISTORY.popitem(last=False)
+    return history
+
+# Messages are written off the request path: persist_message(s) only enqueues,
+# and a single background task inserts them in batches. Each queue item is the
+# list of rows from one call, so a turn's writes always share an INSERT.
+MSG_BATCH_SIZE = 64
+MSG_FLUSH_INTERVAL = 0.05
+# A failed batch is retried once after a short pause before it is dropped
+MSG_WRITE_ATTEMPTS = 2
+MSG_RETRY_DELAY = 0.5
+_MSG_QUEUE: asyncio.Queue = asyncio.Queue()
+_msg_writer_task = None
+
+async def _msg_writer():
+    """Drain the message queue, inserting about MSG_BATCH_SIZE rows per commit."""
+    while True:
+        rows = list(await _MSG_QUEUE.get())
+        items = 1
+        while len(rows) < MSG_BATCH_SIZE:
+            try:
+                rows.extend(await asyncio.wait_for(_MSG_QUEUE.get(), timeout=MSG_FLUSH_INTERVAL))
+                items += 1
+            except asyncio.TimeoutError:
+                break
+        try:
+            for attempt in range(1, MSG_WRITE_ATTEMPTS + 1):
+                try:
+                    async with AsyncSessionLocal() as session:
+                        await session.execute(sqlalchemy.insert(Message), rows)
+                        await session.commit()
+                    break
+                except Exception:
+                    if attempt == MSG_WRITE_ATTEMPTS:
+                        logger.exception("Dropping %d messages after %d failed inserts", len(rows), attempt)
+                    else:
+                        logger.warning("Inserting %d messages failed; retrying", len(rows), exc_info=True)
+                        await asyncio.sleep(MSG_RETRY_DELAY)
+        finally:
+            for _ in range(items):
+                _MSG_QUEUE.task_done()
+
+def start_message_writer():
+    """Start the background message writer (call once from app startup)."""
+    global _msg_writer_task
+    if _msg_writer_task is None or _msg_writer_task.done():
+        _msg_writer_task = asyncio.create_task(_msg_writer())
+
+async def stop_message_writer():
+    """Flush queued messages and stop the background writer."""
+    global _msg_writer_task
+    if _msg_writer_task is None:
+        return
+    await _MSG_QUEUE.join()
+    _msg_writer_task.cancel()
+    _msg_writer_task = None
+
+async def persist_messages(user_id: str, messages: list):
+    """Queue several (role, content) messages to be stored in one INSERT."""
+    if not messages:
+        return
+    history = _recent_history(user_id)
+    if history is None:
+        async with AsyncSessionLocal() as session:
+            history = await _load_history(session, user_id)
+    rows = []
+    for role, content in messages:
+        history.append({"role": role, "content": content})
+        rows.append({"user_id": user_id, "role": role, "content": content})
+    await _MSG_QUEUE.put(rows)
 
 async def persist_message(user_id: str, role: str, content: str):
-    """Store a message in the database."""
-    async with AsyncSessionLocal() as session:
-        msg = Message(user_id=user_id, role=role, content=content)
-        session.add(msg)
-        await session.commit()
-
-async def get_last_n_messages(user_id: str, n: int = 3):
-    """Retrieve the last n messages for a user."""
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            sqlalchemy.select(Message)
-            .where(Message.user_id == user_id)
-            .order_by(Message.created_at.desc())
-            .limit(n)
-        )
-        results = q.scalars().all()
-        return [{"role": r.role, "content": r.content} for r in results]
+    """Queue a message for storage in the database."""
+    await persist_messages(user_id, [(role, content)])
+
+async def get_last_n_messages(session: AsyncSession, user_id: str, n: int = 3):
+    """Retrieve the last n messages for a user, newest first."""
+    if n <= HISTORY_WINDOW:
+        history = _recent_history(user_id)
+        if history is None:
+            history = await _load_history(session, user_id)
+        return list(itertools.islice(reversed(history), n))
+    q = await session.execute(
+        sqlalchemy.select(Message.role, Message.content)
+        .where(Message.user_id == user_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(n)
+    )
+    return [{"role": role, "content": content} for role, content in q]
 
-async def get_all_messages_for_user(user_id: str):
+async def get_all_messages_for_user(session: AsyncSession, user_id: str):
     """Get all messages for a user ordered by creation time."""
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            sqlalchemy.select(Message)
-            .where(Message.user_id == user_id)
-            .order_by(Message.created_at)
+    q = await session.execute(
+        sqlalchemy.select(Message.role, Message.content, Message.created_at)
+        .where(Message.user_id == user_id)
+        .order_by(Message.created_at, Message.id)
+    )
+    # created_at stays a datetime; the response encoder serializes it
+    return [dict(row) for row in q.mappings()]
+
+def _order_status_query():
+    """Select just the order-status columns, joining the product in the same row."""
+    return (
+        select(
+            Order.order_id,
+            Order.status,
+            Order.tracking,
+            Order.user_id,
+            Product.id.label("product_id"),
+            Product.name.label("product_name"),
         )
-        items = q.scalars().all()
-        return [
-            {
-                "role": item.role, 
-                "content": item.content, 
-                "created_at": item.created_at.isoformat()
-            }
-            for item in items
-        ]
-
-async def get_order_status(order_id: str):
+        .join(Product, Order.product_id == Product.id, isouter=True)
+    )
+
+async def get_order_status(session: AsyncSession, order_id: str):
     """Get order status by order ID (any user)."""
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            select(Order)
-            .options(selectinload(Order.product))
-            .where(Order.order_id == order_id)
-        )
-        order = q.scalars().first()
-        if not order:
-            return {"found": False, "order_id": order_id}
-        return {
-            "found": True,
-            "order_id": order.order_id,
-            "status": order.status,
-            "tracking": order.tracking,
-            "user_id": order.user_id,
-            "product_id": order.product.id if order.product else None,
-            "product_name": order.product.name if order.product else None,
-        }
+    q = await session.execute(
+        _order_status_query().where(Order.order_id == order_id)
+    )
+    row = q.first()
+    if not row:
+        return {"found": False, "order_id": order_id}
+    return {"found": True, **row._mapping}
 
 async def get_user_order_status(session: AsyncSession, user_id: str, order_id: str):
     """Get order status for a specific user's order."""
     q = await session.execute(
-        select(Order)
-        .options(selectinload(Order.product))
+        _order_status_query().where(Order.order_id == order_id, Order.user_id == user_id)
+    )
+    row = q.first()
+    if not row:
+        return {"found": False, "order_id": order_id}
+    return {"found": True, **row._mapping}
+
+async def get_order_bundle(session: AsyncSession, user_id: str, order_id: str):
+    """Get a user's order together with its product and warranty in one query."""
+    q = await session.execute(
+        select(
+            Order.order_id,
+            Order.status,
+            Order.tracking,
+            Order.user_id,
+            Product.id.label("product_id"),
+            Product.name.label("product_name"),
+            Warranty.duration_months,
+            Warranty.terms,
+        )
+        .join(Product, Order.product_id == Product.id, isouter=True)
+        .join(Warranty, Product.warranty_id == Warranty.id, isouter=True)
         .where(Order.order_id == order_id, Order.user_id == user_id)
     )
-    order = q.scalars().first()
-    if not order:
+    row = q.mappings().first()
+    if not row:
         return {"found": False, "order_id": order_id}
     return {
         "found": True,
-        "order_id": order.order_id,
-        "status": order.status,
-        "tracking": order.tracking,
-        "user_id": order.user_id,
-        "product_id": order.product.id if order.product else None,
-        "product_name": order.product.name if order.product else None,
+        "order": {
+            "order_id": row["order_id"],
+            "status": row["status"],
+            "tracking": row["tracking"],
+            "user_id": row["user_id"],
+        },
+        "product": {
+            "id": row["product_id"],
+            "name": row["product_name"],
+        } if row["product_id"] else None,
+        "warranty": {
+            "duration_months": row["duration_months"],
+            "terms": row["terms"],
+        } if row["duration_months"] is not None else None,
     }
 
 async def get_latest_order_for_user(session: AsyncSession, user_id: str):
-    """Get the most recent order for a user."""
+    """Get the status of a user's most recent order, or None if they have none."""
     q = await session.execute(
-        select(Order)
-        .options(selectinload(Order.product))
+        _order_status_query()
         .where(Order.user_id == user_id)
-        .order_by(Order.created_at.desc())
+        .order_by(Order.created_at.desc(), Order.id.desc())
         .limit(1)
     )
-    return q.scalars().first()
+    row = q.first()
+    if not row:
+        return None
+    return {"found": True, **row._mapping}
 
-async def get_all_orders_for_user(user_id: str):
+async def get_all_orders_for_user(session: AsyncSession, user_id: str):
     """Get all orders for a specific user."""
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            select(Order)
-            .options(selectinload(Order.product))
-            .where(Order.user_id == user_id)
-            .order_by(Order.created_at.desc())
+    q = await session.execute(
+        select(
+            Order.order_id,
+            Order.status,
+            Order.tracking,
+            Order.created_at,
+            Product.id.label("product_id"),
+            Product.name.label("product_name"),
         )
-        orders = q.scalars().all()
-        return [
-            {
-                "order_id": order.order_id,
-                "status": order.status,
-                "tracking": order.tracking,
-                "created_at": order.created_at.isoformat(),
-                "product_id": order.product.id if order.product else None,
-                "product_name": order.product.name if order.product else None,
-            }
-            for order in orders
-        ]
+        .join(Product, Order.product_id == Product.id, isouter=True)
+        .where(Order.user_id == user_id)
+        .order_by(Order.created_at.desc(), Order.id.desc())
+    )
+    return [dict(row) for row in q.mappings()]
+
+def _catalog_key(product_identifier: str):
+    """Product ID to cache a lookup under, or None for free-text names.
+
+    Caching on the resolved ID keeps the caches bounded by the catalog size;
+    arbitrary strings from the public endpoints never become keys.
+    """
+    product_id = resolve_product_id(product_identifier)
+    if product_id is None and _PID_RE.match(product_identifier):
+        product_id = product_identifier
+    return product_id
 
 async def get_product_info(session: AsyncSession, product_identifier: str):
     """Get product information by product ID or name."""
-    # First try to find by exact product ID
+    product_id = _catalog_key(product_identifier)
+    if product_id is None:
+        return await _load_product_info(session, product_identifier)
+    return await _cached(
+        _PRODUCT_CACHE,
+        product_id,
+        CACHE_TTL_SECONDS,
+        lambda: _load_product_info(session, product_id),
+    )
+
+async def _load_product_info(session: AsyncSession, product_identifier: str):
+    # First try to find by exact (or synonym-resolved) product ID
+    product_id = resolve_product_id(product_identifier) or product_identifier
     result = await session.execute(
-        select(Product).where(Product.id == product_identifier)
+        select(Product).where(Product.id == product_id)
     )
     product = result.scalar_one_or_none()
     
     # If not found and identifier doesn't look like a product ID, try name search
-    if not product and not product_identifier.startswith('P'):
+    if not product and not _PID_RE.match(product_identifier):
+        like_pat = f"%{product_identifier}%"
         result = await session.execute(
             select(Product)
-            .where(Product.name.ilike(f"%{product_identifier}%"))
+            .where(Product.name.ilike(like_pat))
         )
         product = result.scalars().first()
     
@@ -144,10 +346,12 @@ async def get_product_info(session: AsyncSession, product_identifier: str):
 
 async def search_product_by_name(session: AsyncSession, product_name: str):
     """Search for product by name (case-insensitive partial match)."""
-    result = await session.execute(
-        select(Product)
-        .where(Product.name.ilike(f"%{product_name}%"))
-    )
+    product_id = resolve_product_id(product_name)
+    if product_id:
+        query = select(Product).where(Product.id == product_id)
+    else:
+        query = select(Product).where(Product.name.ilike(f"%{product_name}%"))
+    result = await session.execute(query)
     products = result.scalars().all()
     return [
         {
@@ -160,39 +364,52 @@ async def search_product_by_name(session: AsyncSession, product_name: str):
         for product in products
     ]
 
-async def get_all_products():
+async def get_all_products(session: AsyncSession):
     """Get all products."""
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(select(Product))
-        products = q.scalars().all()
-        return [
-            {
-                "id": p.id,
-                "name": p.name,
-                "description": p.description,
-                "pros": p.pros,
-                "cons": p.cons,
-                "warranty_id": p.warranty_id,
-            }
-            for p in products
-        ]
+    return await _cached(_PRODUCT_CACHE, None, CACHE_TTL_SECONDS, lambda: _load_all_products(session))
+
+async def _load_all_products(session: AsyncSession):
+    q = await session.execute(
+        select(
+            Product.id,
+            Product.name,
+            Product.description,
+            Product.pros,
+            Product.cons,
+            Product.warranty_id,
+        )
+    )
+    return [dict(row) for row in q.mappings()]
 
 async def get_warranty_info(session: AsyncSession, product_identifier: str):
     """Get warranty information for a product by ID or name."""
-    # First try to find by exact product ID
+    product_id = _catalog_key(product_identifier)
+    if product_id is None:
+        return await _load_warranty_info(session, product_identifier)
+    return await _cached(
+        _WARRANTY_CACHE,
+        product_id,
+        CACHE_TTL_SECONDS,
+        lambda: _load_warranty_info(session, product_id),
+    )
+
+async def _load_warranty_info(session: AsyncSession, product_identifier: str):
+    # First try to find by exact (or synonym-resolved) product ID
+    product_id = resolve_product_id(product_identifier) or product_identifier
     result = await session.execute(
         select(Product)
-        .options(selectinload(Product.warranty))
-        .where(Product.id == product_identifier)
+        .options(joinedload(Product.warranty))
+        .where(Product.id == product_id)
     )
     product = result.scalar_one_or_none()
     
     # If not found and identifier doesn't look like a product ID, try name search
-    if not product and not product_identifier.startswith('P'):
+    if not product and not _PID_RE.match(product_identifier):
+        like_pat = f"%{product_identifier}%"
         result = await session.execute(
             select(Product)
-            .options(selectinload(Product.warranty))
-            .where(Product.name.ilike(f"%{product_identifier}%"))
+            .options(joinedload(Product.warranty))
+            .where(Product.name.ilike(like_pat))
         )
         product = result.scalars().first()
     
@@ -205,16 +422,12 @@ async def get_warranty_info(session: AsyncSession, product_identifier: str):
         }
     return None
 
-async def get_all_warranties():
+async def get_all_warranties(session: AsyncSession):
     """Get all warranty policies."""
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(select(Warranty))
-        warranties = q.scalars().all()
-        return [
-            {
-                "id": w.id,
-                "duration_months": w.duration_months,
-                "terms": w.terms,
-            }
-            for w in warranties
-        ]
\ No newline at end of file
+    return await _cached(_WARRANTY_CACHE, None, CACHE_TTL_SECONDS, lambda: _load_all_warranties(session))
+
+async def _load_all_warranties(session: AsyncSession):
+    q = await session.execute(
+        select(Warranty.id, Warranty.duration_months, Warranty.terms)
+    )
+    return [dict(row) for row in q.mappings()]
\ No newline at end of file
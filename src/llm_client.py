@@ -1,13 +1,23 @@
 from dotenv import load_dotenv
+from functools import lru_cache
+import asyncio
 import os
-import requests
-import json
+import re
+import httpx
+import orjson
 
 load_dotenv()
 
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
 
+# One pooled client for the whole process so keep-alive connections to
+# Ollama are reused across chat turns
+_HTTP = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0),
+    limits=httpx.Limits(max_keepalive_connections=32),
+)
+
 # Try to use LangChain Ollama wrapper if available
 USE_LANGCHAIN = False
 try:
@@ -17,80 +27,130 @@ try:
 except Exception:
     USE_LANGCHAIN = False
 
-def _prompt_with_history(last_messages, user_message):
-    history_text = ""
-    for m in last_messages:
-        history_text += f"{m['role'].capitalize()}: {m['content']}\n"
-
-    prompt = (
-        "Anda adalah asisten customer support e-commerce yang ramah dan membantu. Anda berkomunikasi dalam bahasa Indonesia.\n"
-        "Anda memiliki akses ke tools berikut:\n"
-        "1. get_order_status(order_id) → mengembalikan status pengiriman pesanan.\n"
-        "2. get_warranty_info(product_id ATAU nama_produk) → mengembalikan kebijakan garansi untuk produk.\n"
-        "3. get_product_info(product_id ATAU nama_produk) → mengembalikan deskripsi produk, kelebihan dan kekurangan.\n\n"
-        
-        "Produk yang tersedia di toko kami:\n"
-        "- Headphone Wireless (ID: P123)\n"
-        "- Smartphone X (ID: P234)\n"
-        "- Gaming Laptop Pro (ID: P345)\n\n"
-        
-        "ATURAN DETEKSI INTENT (analisis pesan user dengan cermat):\n\n"
-        
-        "1. DETEKSI ORDER/PESANAN:\n"
-        "   - Jika ada kode ORD (misal: ORD12345, ORD23456) → get_order_status dengan kode tersebut\n"
-        "   - Kata kunci: 'pesanan', 'order', 'status', 'dimana', 'kapan sampai', 'tracking', 'pengiriman'\n"
-        "   - Frasa: 'pesanan saya', 'status pesanan', 'dimana pesanan', 'order saya'\n"
-        "   - Jika tidak ada kode ORD tapi menanyakan pesanan → get_order_status dengan input kosong\n\n"
-        
-        "2. DETEKSI GARANSI:\n"
-        "   - Kata kunci: 'garansi', 'warranty', 'jaminan', 'klaim', 'rusak', 'bermasalah'\n"
-        "   - Frasa: 'garansi produk', 'cara klaim', 'masa garansi', 'warranty info'\n"
-        "   - Jika menyebut produk (ID/nama) + garansi → get_warranty_info dengan produk tersebut\n"
-        "   - Jika hanya 'garansi' tanpa produk spesifik:\n"
-        "     * Cek riwayat chat untuk produk yang disebutkan sebelumnya\n"
-        "     * Atau cek pesanan terakhir user untuk mendapat produk\n"
-        "     * Jika tidak ada, tanya produk mana\n\n"
-        
-        "3. DETEKSI INFO PRODUK:\n"
-        "   - Kata kunci: 'kelebihan', 'kekurangan', 'pros', 'cons', 'deskripsi', 'detail', 'spesifikasi'\n"
-        "   - Kata: 'tentang', 'info', 'informasi', 'review', 'bagaimana', 'seperti apa'\n"
-        "   - Frasa: 'apa kelebihan', 'gimana produk', 'ceritain tentang', 'pengen tau'\n"
-        "   - Deteksi nama produk dalam berbagai variasi:\n"
-        "     * 'headphone', 'wireless headphone', 'earphone'\n"
-        "     * 'smartphone', 'hp', 'ponsel', 'handphone'\n"
-        "     * 'laptop', 'gaming laptop', 'laptop gaming'\n\n"
-        
-        "4. KONTEKS CERDAS:\n"
-        "   - Gunakan riwayat percakapan untuk memahami konteks\n"
-        "   - Jika user bertanya 'garansinya?' setelah membahas produk, asumsikan produk yang sama\n"
-        "   - Jika user bertanya 'pesananku?' tanpa menyebut kode, cari pesanan terakhir\n"
-        "   - Ingat produk yang sedang dibahas dalam percakapan\n\n"
-        
-        "5. SMART MATCHING:\n"
-        "   - 'headphone'/'earphone' → Headphone Wireless\n"
-        "   - 'hp'/'smartphone'/'ponsel' → Smartphone X  \n"
-        "   - 'laptop'/'gaming' → Gaming Laptop Pro\n"
-        "   - Bisa menggunakan ID (P123) atau nama partial\n\n"
-        
-        "Riwayat percakapan (gunakan untuk konteks):\n"
-        f"{history_text}\n"
-        f"User: {user_message}\n\n"
-        
-        "Output format:\n"
-        "1. JSON action di baris pertama: {\"action\":\"nama_tool\",\"action_input\":\"parameter\"}\n"
-        "2. Balasan natural dalam bahasa Indonesia\n\n"
-        
-        "Contoh:\n"
-        '{"action":"get_order_status","action_input":"ORD12345"}\nSaya cek status pesanan ORD12345 dulu ya.\n\n'
-        '{"action":"get_order_status","action_input":""}\nSaya cek pesanan terakhir Anda.\n\n'
-        '{"action":"get_warranty_info","action_input":"headphone wireless"}\nBerikut info garansi untuk Headphone Wireless.\n\n'
-        '{"action":"get_product_info","action_input":"smartphone"}\nIni detail lengkap Smartphone X.\n\n'
-        '{"action":"none","action_input":""}\nAda yang bisa saya bantu?\n\n'
-    )
-
-    return prompt
-
-def call_ollama_http(prompt, temperature=0.0, max_tokens=512):
+_SYSTEM_PROMPT_PREFIX = (
+    "Anda adalah asisten customer support e-commerce yang ramah dan membantu. Anda berkomunikasi dalam bahasa Indonesia.\n"
+    "Anda memiliki akses ke tools berikut:\n"
+    "1. get_order_status(order_id) → mengembalikan status pengiriman pesanan.\n"
+    "2. get_warranty_info(product_id ATAU nama_produk) → mengembalikan kebijakan garansi untuk produk.\n"
+    "3. get_product_info(product_id ATAU nama_produk) → mengembalikan deskripsi produk, kelebihan dan kekurangan.\n"
+    "4. get_order_bundle(order_id) → mengembalikan status pesanan sekaligus garansi produknya.\n\n"
+    
+    "Produk yang tersedia di toko kami:\n"
+    "- Headphone Wireless (ID: P123)\n"
+    "- Smartphone X (ID: P234)\n"
+    "- Gaming Laptop Pro (ID: P345)\n\n"
+    
+    "ATURAN DETEKSI INTENT (analisis pesan user dengan cermat):\n\n"
+    
+    "1. DETEKSI ORDER/PESANAN:\n"
+    "   - Jika ada kode ORD (misal: ORD12345, ORD23456) → get_order_status dengan kode tersebut\n"
+    "   - Kata kunci: 'pesanan', 'order', 'status', 'dimana', 'kapan sampai', 'tracking', 'pengiriman'\n"
+    "   - Frasa: 'pesanan saya', 'status pesanan', 'dimana pesanan', 'order saya'\n"
+    "   - Jika tidak ada kode ORD tapi menanyakan pesanan → get_order_status dengan input kosong\n\n"
+    
+    "2. DETEKSI GARANSI:\n"
+    "   - Kata kunci: 'garansi', 'warranty', 'jaminan', 'klaim', 'rusak', 'bermasalah'\n"
+    "   - Frasa: 'garansi produk', 'cara klaim', 'masa garansi', 'warranty info'\n"
+    "   - Jika menyebut produk (ID/nama) + garansi → get_warranty_info dengan produk tersebut\n"
+    "   - Jika hanya 'garansi' tanpa produk spesifik:\n"
+    "     * Cek riwayat chat untuk produk yang disebutkan sebelumnya\n"
+    "     * Atau cek pesanan terakhir user untuk mendapat produk\n"
+    "     * Jika tidak ada, tanya produk mana\n\n"
+    
+    "3. DETEKSI INFO PRODUK:\n"
+    "   - Kata kunci: 'kelebihan', 'kekurangan', 'pros', 'cons', 'deskripsi', 'detail', 'spesifikasi'\n"
+    "   - Kata: 'tentang', 'info', 'informasi', 'review', 'bagaimana', 'seperti apa'\n"
+    "   - Frasa: 'apa kelebihan', 'gimana produk', 'ceritain tentang', 'pengen tau'\n"
+    "   - Deteksi nama produk dalam berbagai variasi:\n"
+    "     * 'headphone', 'wireless headphone', 'earphone'\n"
+    "     * 'smartphone', 'hp', 'ponsel', 'handphone'\n"
+    "     * 'laptop', 'gaming laptop', 'laptop gaming'\n\n"
+    
+    "4. DETEKSI PESANAN + GARANSI:\n"
+    "   - Jika user menanyakan status pesanan DAN garansinya sekaligus → get_order_bundle dengan kode ORD\n"
+    "   - Contoh: 'status ORD12345 dan garansinya?', 'pesanan ORD34567 masih garansi?'\n\n"
+    
+    "5. KONTEKS CERDAS:\n"
+    "   - Gunakan riwayat percakapan untuk memahami konteks\n"
+    "   - Jika user bertanya 'garansinya?' setelah membahas produk, asumsikan produk yang sama\n"
+    "   - Jika user bertanya 'pesananku?' tanpa menyebut kode, cari pesanan terakhir\n"
+    "   - Ingat produk yang sedang dibahas dalam percakapan\n\n"
+    
+    "6. SMART MATCHING:\n"
+    "   - 'headphone'/'earphone' → Headphone Wireless\n"
+    "   - 'hp'/'smartphone'/'ponsel' → Smartphone X  \n"
+    "   - 'laptop'/'gaming' → Gaming Laptop Pro\n"
+    "   - Bisa menggunakan ID (P123) atau nama partial\n\n"
+    
+    "Output format:\n"
+    "1. JSON action di baris pertama: {\"action\":\"nama_tool\",\"action_input\":\"parameter\"}\n"
+    "2. Balasan natural dalam bahasa Indonesia\n\n"
+    
+    "Contoh:\n"
+    '{"action":"get_order_status","action_input":"ORD12345"}\nSaya cek status pesanan ORD12345 dulu ya.\n\n'
+    '{"action":"get_order_status","action_input":""}\nSaya cek pesanan terakhir Anda.\n\n'
+    '{"action":"get_warranty_info","action_input":"headphone wireless"}\nBerikut info garansi untuk Headphone Wireless.\n\n'
+    '{"action":"get_product_info","action_input":"smartphone"}\nIni detail lengkap Smartphone X.\n\n'
+    '{"action":"get_order_bundle","action_input":"ORD12345"}\nSaya cek status pesanan ORD12345 beserta garansinya.\n\n'
+    '{"action":"none","action_input":""}\nAda yang bisa saya bantu?\n\n'
+    
+    "Riwayat percakapan (gunakan untuk konteks):\n"
+)
+
+# The model sees the last few messages, capped at a rough token budget (about
+# four characters per token). Messages that do not fit, and turns older than
+# that window, reach it only as a one-line summary of the orders, products
+# and tools they mention.
+HISTORY_TOKEN_BUDGET = 1024
+
+_ORD_RE = re.compile(r"\bORD\d+\b", re.I)
+_PRODUCT_ID_RE = re.compile(r"\bP\d+\b")
+
+def _estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def summarize_turns(messages):
+    """Condense older turns into the orders, products and tools they mention."""
+    orders, products, tools = {}, {}, {}
+    for m in messages:
+        content = m["content"]
+        orders.update(dict.fromkeys(o.upper() for o in _ORD_RE.findall(content)))
+        products.update(dict.fromkeys(_PRODUCT_ID_RE.findall(content)))
+        if m["role"] == "tool":
+            try:
+                tools[orjson.loads(content)["tool"]] = None
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                pass
+    parts = []
+    if orders:
+        parts.append("pesanan " + ", ".join(orders))
+    if products:
+        parts.append("produk " + ", ".join(products))
+    if tools:
+        parts.append("tools " + ", ".join(tools))
+    return "; ".join(parts)
+
+def _budget_history(last_messages, budget=HISTORY_TOKEN_BUDGET):
+    """Split newest-first history into the turns that fit the budget and the rest."""
+    used = 0
+    for i, m in enumerate(last_messages):
+        used += _estimate_tokens(m["content"])
+        # The newest message is always kept, even if it alone is over budget
+        if used > budget and i > 0:
+            return last_messages[:i], last_messages[i:]
+    return last_messages, []
+
+def _prompt_with_history(last_messages, user_message, summary=""):
+    # Everything that never changes comes first, so the backend can reuse the
+    # cached prefix across turns; only history and the new message follow it
+    recent, overflow = _budget_history(last_messages)
+    summary = "; ".join(part for part in (summarize_turns(overflow), summary) if part)
+    history_text = f"Ringkasan sebelumnya: {summary}\n" if summary else ""
+    history_text += "".join(f"{m['role'].capitalize()}: {m['content']}\n" for m in recent)
+    return f"{_SYSTEM_PROMPT_PREFIX}{history_text}\nUser: {user_message}\n"
+
+async def call_ollama_http_stream(prompt, temperature=0.0, max_tokens=512):
+    """Yield response chunks from Ollama as they are generated."""
     url = OLLAMA_API_URL.rstrip("/") + "/api/generate"
     payload = {
         "model": OLLAMA_MODEL,
@@ -99,21 +159,32 @@ def call_ollama_http(prompt, temperature=0.0, max_tokens=512):
         "max_tokens": max_tokens,
     }
     try:
-        r = requests.post(url, json=payload, timeout=60, stream=True)
-        r.raise_for_status()
-        output = ""
-        for line in r.iter_lines():
-            if not line:
-                continue
-            data = json.loads(line.decode("utf-8"))
-            if "response" in data:
-                output += data["response"]
-            if data.get("done", False):
-                break
-        return output.strip()
+        async with _HTTP.stream(
+            "POST",
+            url,
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        ) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line:
+                    continue
+                data = orjson.loads(line)
+                if "response" in data:
+                    yield data["response"]
+                if data.get("done", False):
+                    break
     except Exception as e:
         raise RuntimeError(f"Ollama HTTP call failed: {e}")
 
+async def close_http_client():
+    """Close the shared Ollama HTTP client (call from app shutdown)."""
+    await _HTTP.aclose()
+
+@lru_cache(maxsize=None)
+def _prompt_template(template):
+    return PromptTemplate(input_variables=["prompt"], template=template)
+
 class LLMClient:
     def __init__(self):
         self.use_langchain = USE_LANGCHAIN
@@ -121,15 +192,25 @@ class LLMClient:
             try:
                 self.llm = Ollama(model=OLLAMA_MODEL, temperature=0.0)
                 self.template = "{prompt}"
-                self.prompt = PromptTemplate(input_variables=["prompt"], template=self.template)
+                self.prompt = _prompt_template(self.template)
                 self.chain = LLMChain(llm=self.llm, prompt=self.prompt)
             except Exception:
                 self.use_langchain = False
 
-    def ask(self, last_messages, user_message):
-        prompt = _prompt_with_history(last_messages, user_message)
+    async def ask(self, last_messages, user_message, summary=""):
+        """Yield the reply in chunks as the model generates it.
+
+        summary condenses turns older than last_messages (see summarize_turns).
+        """
+        prompt = _prompt_with_history(last_messages, user_message, summary)
         if self.use_langchain:
-            resp = self.chain.run(prompt=prompt)
-            return resp
+            # LLMChain.run is blocking and not incremental; keep it off the event loop
+            yield await asyncio.to_thread(self.chain.run, prompt=prompt)
         else:
-            return call_ollama_http(prompt)
\ No newline at end of file
+            async for chunk in call_ollama_http_stream(prompt):
+                yield chunk
+
+@lru_cache(maxsize=None)
+def get_client():
+    """Return the process-wide LLMClient, building its chain on first use."""
+    return LLMClient()
\ No newline at end of file
@@ -1,31 +1,59 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
-from src.db_model import AsyncSessionLocal, Order, Product
-from src.db_seed import init_database, create_tables, seed_database
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db_model import AsyncSessionLocal, Order, Product, get_session
+from src.db_seed import init_database, create_tables, seed_database, clear_tables
 from src.db_tool import (
     persist_message,
+    persist_messages,
     get_last_n_messages,
     get_all_messages_for_user,
     get_order_status,
     get_user_order_status,
+    get_order_bundle,
     get_latest_order_for_user,
     get_all_orders_for_user,
     get_product_info,
     search_product_by_name,
     get_all_products,
     get_warranty_info,
-    get_all_warranties
+    get_all_warranties,
+    invalidate_caches,
+    start_message_writer,
+    stop_message_writer,
+    HISTORY_WINDOW,
+    PRODUCT_SYNONYMS,
 )
-from src.llm_client import LLMClient
+from src.llm_client import get_client, close_http_client, summarize_turns
+from contextlib import aclosing
+import ahocorasick
+import asyncio
+import hashlib
 import json
+import orjson
 import sqlalchemy
 import re
 import time
 
 app = FastAPI(title="E-commerce Support Chatbot")
 
-llm = LLMClient()
+# Patterns used on every chat turn, compiled once. They run against the
+# lowercased message, so none needs re.I; captured IDs are upper-cased.
+ORDER_ID_RE = re.compile(r"(ord\d+)")
+PRODUCT_ID_RE = re.compile(r"\bp\d+\b")
+ORDER_KW_RE = re.compile(r"\b(pesanan saya|status pesanan|dimana pesanan|my order|order status)\b")
+WARRANTY_KW_RE = re.compile(r"\b(garansi|warranty|guarantee|jaminan)\b")
+# Looser form that also catches suffixed words such as "garansinya"
+WARRANTY_MENTION_RE = re.compile(r"garansi|warranty|guarantee|jaminan")
+INFO_KW_RE = re.compile(r"\b(kelebihan|kekurangan|deskripsi|detail|spesifikasi|tentang|pros|cons|description|about|info)\b")
+PRODUCT_INTENT_RE = re.compile(
+    r"\b(?:(?P<pros>kelebihan|keunggulan|pros|advantage)"
+    r"|(?P<cons>kekurangan|kelemahan|cons|disadvantage)"
+    r"|(?P<desc>deskripsi|description|detail|tentang|about))\b"
+)
+
+llm = get_client()
 
 # Pydantic models
 class ChatRequest(BaseModel):
@@ -41,138 +69,232 @@ class ChatResponse(BaseModel):
 async def startup_event():
     """Initialize database on startup."""
     await init_database()
+    start_message_writer()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush pending message writes and release the LLM HTTP client before exit."""
+    await stop_message_writer()
+    await close_http_client()
+
+_JSON_DECODER = json.JSONDecoder()
 
 def try_parse_json_action(text: str):
     """Find the first JSON object in text and parse it. Returns dict or None."""
+    start = text.find("{")
+    if start == -1:
+        return None
     try:
-        start = text.find("{")
-        end = text.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            candidate = text[start : end + 1]
-            j = json.loads(candidate)
-            return j
+        # Decode exactly one object; prose or more JSON after it is ignored
+        j, _ = _JSON_DECODER.raw_decode(text, start)
+        return j
     except Exception:
         return None
-    return None
 
-# Cache for product patterns to avoid repeated DB queries
-_product_patterns_cache = None
-_cache_timestamp = None
+# LLM replies keyed by the exact message and history the model was shown, so
+# a repeated question in the same context is answered without generating again
+RESPONSE_CACHE_TTL = 900
+RESPONSE_CACHE_MAX = 10_000
+_response_cache: dict[str, tuple[float, str]] = {}
+
+def _response_cache_key(last_messages: list, user_message: str, summary: str):
+    normalized = " ".join(user_message.lower().split())
+    context = "|".join(f"{m['role']}:{m['content']}" for m in last_messages)
+    return hashlib.blake2b(f"{normalized}|{context}|{summary}".encode(), digest_size=16).hexdigest()
+
+async def collect_llm_reply(last_messages: list, user_message: str, summary: str = ""):
+    """Return the LLM reply, from the response cache when possible."""
+    key = _response_cache_key(last_messages, user_message, summary)
+    now = time.monotonic()
+    hit = _response_cache.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+
+    text = await _stream_llm_reply(last_messages, user_message, summary)
+    if len(_response_cache) >= RESPONSE_CACHE_MAX:
+        # Drop the oldest entry (dicts keep insertion order)
+        _response_cache.pop(next(iter(_response_cache)))
+    _response_cache[key] = (now + RESPONSE_CACHE_TTL, text)
+    return text
+
+async def _stream_llm_reply(last_messages: list, user_message: str, summary: str):
+    """Stream the LLM reply, stopping early once the action line names a tool.
+
+    When a tool runs, the reply is rebuilt from the tool output, so anything
+    the model generates after the action line would be discarded anyway.
+    """
+    chunks = []
+    action_checked = False
+    async with aclosing(llm.ask(last_messages, user_message, summary)) as stream:
+        async for chunk in stream:
+            chunks.append(chunk)
+            if not action_checked and "\n" in chunk:
+                action_checked = True
+                first_line = "".join(chunks).lstrip().split("\n", 1)[0]
+                action = try_parse_json_action(first_line)
+                if action and action.get("action") and action.get("action") != "none":
+                    break
+    return "".join(chunks).strip()
+
+# Cache for product patterns to avoid repeated DB queries. The whole entry is
+# one tuple (monotonic expiry, automaton, index, shortest key length) that is
+# replaced in a single assignment, so readers never see a half-updated cache.
+# The index maps each lowered product name or word to the canonical product
+# name.
+PATTERNS_CACHE_TTL = 300
+_patterns_entry: Optional[tuple] = None
+# Only one coroutine rebuilds an expired cache; the rest wait for its result
+_patterns_lock = asyncio.Lock()
 
 async def get_product_patterns():
-    """Generate product name patterns dynamically from database with caching."""
-    global _product_patterns_cache, _cache_timestamp
-    import time
-    
+    """Return (automaton, index, shortest key length) for product-name matching, with caching."""
     # Cache for 5 minutes
-    if (_product_patterns_cache is not None and 
-        _cache_timestamp is not None and 
-        time.time() - _cache_timestamp < 300):
-        return _product_patterns_cache
+    entry = _patterns_entry
+    if entry and entry[0] > time.monotonic():
+        return entry[1:]
     
+    async with _patterns_lock:
+        # Another waiter may have rebuilt the cache while we queued
+        entry = _patterns_entry
+        if entry and entry[0] > time.monotonic():
+            return entry[1:]
+        return await _rebuild_product_patterns()
+
+async def _rebuild_product_patterns():
+    global _patterns_entry
     async with AsyncSessionLocal() as session:
-        q = await session.execute(sqlalchemy.select(Product))
-        products = q.scalars().all()
-        
-        patterns = []
-        product_mapping = {}
-        
-        for product in products:
-            # Add exact product name
-            exact_pattern = rf"\b({re.escape(product.name.lower())})\b"
-            patterns.append(exact_pattern)
-            product_mapping[exact_pattern] = product.name
-            
-            # Add individual significant words (skip common words)
-            name_words = product.name.lower().split()
-            significant_words = [word for word in name_words if len(word) > 3]
-            
-            for word in significant_words:
-                word_pattern = rf"\b({re.escape(word)})\b"
-                patterns.append(word_pattern)
-                product_mapping[word_pattern] = product.name
-        
-        _product_patterns_cache = (patterns, product_mapping)
-        _cache_timestamp = time.time()
-        
-        return _product_patterns_cache
+        q = await session.execute(sqlalchemy.select(Product.id, Product.name))
+        names = dict(q.all())
+    
+    # Lower and split each name once. Keys are full names and significant
+    # words (skip common words), then the everyday synonyms users type
+    # ("hp", "ponsel", ...); the first product to claim a word keeps it.
+    index = {}
+    for name in names.values():
+        lowered = name.lower()
+        index.setdefault(lowered, name)
+        for word in lowered.split():
+            if len(word) > 3:
+                index.setdefault(word, name)
+    for word, product_id in PRODUCT_SYNONYMS.items():
+        if product_id in names:
+            index.setdefault(word, names[product_id])
+    
+    # One automaton over every indexed keyword, so a single pass over the
+    # message finds any product mention. Values are (keyword length,
+    # product name).
+    automaton = ahocorasick.Automaton()
+    for keyword, name in index.items():
+        automaton.add_word(keyword, (len(keyword), name))
+    automaton.make_automaton()
+    
+    shortest = min(map(len, index), default=0)
+    _patterns_entry = (time.monotonic() + PATTERNS_CACHE_TTL, automaton, index, shortest)
+    return automaton, index, shortest
+
+def _is_word_char(ch: str):
+    return ch.isalnum() or ch == "_"
 
-async def extract_patterns(message: str):
-    """Extract order IDs, product IDs, and product names from message."""
+async def extract_patterns(msg_lower: str):
+    """Extract order IDs, product IDs, and product names from a lowercased message."""
     patterns = {
-        "order_id": re.search(r"(ORD\d+)", message, re.I),
-        "product_id": re.search(r"(P\d+)", message, re.I),
+        "order_id": ORDER_ID_RE.search(msg_lower),
+        "product_id": PRODUCT_ID_RE.search(msg_lower),
         "product_name": None,
         "matched_product": None
     }    
 
-    pattern_list, product_mapping = await get_product_patterns()
+    automaton, index, shortest = await get_product_patterns()
+    # A message shorter than every indexed name, word and synonym cannot
+    # mention a product; skip the scan
+    if not len(automaton) or len(msg_lower) < shortest:
+        return patterns
+    
+    # A message that is just a product name or word needs no scan
+    exact = index.get(msg_lower.strip())
+    if exact:
+        patterns["product_name"] = msg_lower.strip()
+        patterns["matched_product"] = exact
+        return patterns
     
-    for pattern in pattern_list:
-        match = re.search(pattern, message, re.I)
-        if match:
-            patterns["product_name"] = match
-            patterns["matched_product"] = product_mapping.get(pattern)
-            break
+    # Leftmost whole-word hit wins; on a tie prefer the longer keyword
+    best = None
+    for end, (length, product_name) in automaton.iter(msg_lower):
+        start = end - length + 1
+        if start > 0 and _is_word_char(msg_lower[start - 1]):
+            continue
+        if end + 1 < len(msg_lower) and _is_word_char(msg_lower[end + 1]):
+            continue
+        if best is None or start < best[0] or (start == best[0] and end > best[1]):
+            best = (start, end, product_name)
+    
+    if best:
+        patterns["product_name"] = msg_lower[best[0] : best[1] + 1]
+        patterns["matched_product"] = best[2]
     
     return patterns
 
-def determine_fallback_action(message: str, patterns: dict):
-    """Determine action based on patterns and keywords when LLM fails."""
+def determine_fallback_action(msg_lower: str, patterns: dict):
+    """Determine action based on patterns and keywords, before asking the LLM."""
     # Order queries
     if patterns["order_id"]:
-        return {"action": "get_order_status", "action_input": patterns["order_id"].group(1)}
+        order_id = patterns["order_id"].group(1).upper()
+        if WARRANTY_MENTION_RE.search(msg_lower):
+            return {"action": "get_order_bundle", "action_input": order_id}
+        return {"action": "get_order_status", "action_input": order_id}
     
-    if re.search(r"\b(pesanan saya|status pesanan|dimana pesanan|my order|order status)\b", message, re.I):
+    if ORDER_KW_RE.search(msg_lower):
         return {"action": "get_order_status", "action_input": ""}
     
     # Warranty queries
-    if re.search(r"\b(garansi|warranty|guarantee|jaminan)\b", message, re.I):
+    if WARRANTY_MENTION_RE.search(msg_lower):
         if patterns["product_id"]:
-            return {"action": "get_warranty_info", "action_input": patterns["product_id"].group(1)}
+            return {"action": "get_warranty_info", "action_input": patterns["product_id"].group(0).upper()}
         elif patterns["product_name"]:
-            return {"action": "get_warranty_info", "action_input": patterns["product_name"].group(1)}
+            return {"action": "get_warranty_info", "action_input": patterns["product_name"]}
     
     # Product info queries
-    if re.search(r"\b(kelebihan|kekurangan|deskripsi|detail|pros|cons|description|about|info)\b", message, re.I):
+    if INFO_KW_RE.search(msg_lower):
         if patterns["product_id"]:
-            return {"action": "get_product_info", "action_input": patterns["product_id"].group(1)}
+            return {"action": "get_product_info", "action_input": patterns["product_id"].group(0).upper()}
         elif patterns["product_name"]:
-            return {"action": "get_product_info", "action_input": patterns["product_name"].group(1)}
+            return {"action": "get_product_info", "action_input": patterns["product_name"]}
     
     return None
 
-async def handle_warranty_safeguard(user_id: str, message: str, last_messages: list):
+async def handle_warranty_safeguard(session: AsyncSession, user_id: str, msg_lower: str, last_messages: list):
     """Handle warranty queries that need product context."""
-    product_match = re.search(r"\bP\d+\b", message)
+    product_match = PRODUCT_ID_RE.search(msg_lower)
+    order_match = ORDER_ID_RE.search(msg_lower)
     
-    if not re.search(r"\b(garansi|warranty)\b", message, re.I):
+    if not WARRANTY_KW_RE.search(msg_lower):
         return None
     
     if product_match:
-        return {"action": "get_warranty_info", "action_input": product_match.group(0)}
+        return {"action": "get_warranty_info", "action_input": product_match.group(0).upper()}
+
+    # Order status and its warranty asked together: answer both in one query
+    if order_match:
+        return {"action": "get_order_bundle", "action_input": order_match.group(1).upper()}
     
     # Search for product context
     chosen_product = None
     
     # Check latest order
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            sqlalchemy.select(Order)
-            .where(Order.user_id == user_id)
-            .order_by(Order.created_at.desc())
-            .limit(1)
-        )
-        last_order = q.scalars().first()
-        if last_order:
-            chosen_product = last_order.product_id
+    q = await session.execute(
+        sqlalchemy.select(Order.product_id)
+        .where(Order.user_id == user_id)
+        .order_by(Order.created_at.desc(), Order.id.desc())
+        .limit(1)
+    )
+    chosen_product = q.scalar()
     
     # Check chat history for product ID
     if not chosen_product:
         for m in last_messages:
-            pm = re.search(r"\bP\d+\b", m["content"])
+            pm = PRODUCT_ID_RE.search(m["content"].lower())
             if pm:
-                chosen_product = pm.group(0)
+                chosen_product = pm.group(0).upper()
                 break
     
     if chosen_product:
@@ -181,39 +303,52 @@ async def handle_warranty_safeguard(user_id: str, message: str, last_messages: l
     return "ask_product"
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, background: BackgroundTasks, session: AsyncSession = Depends(get_session)):
     user_id = req.user_id
     user_message = req.message.strip()
+    # Every keyword/ID pattern runs on this; the original text is kept for
+    # storage and the LLM
+    msg_lower = user_message.lower()
 
-    # Store user message
+    # Store user message inline: the history read below must already see it.
+    # The tool and assistant writes are collected in pending_writes and
+    # queued together after the response.
     await persist_message(user_id, "user", user_message)
 
-    # Fetch last 3 messages for context
-    last_messages = await get_last_n_messages(user_id, n=3)
-
-    # Ask LLM
-    try:
-        llm_text = llm.ask(last_messages, user_message)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LLM error: {e}")
-
-    action_json = try_parse_json_action(llm_text)
+    # Fetch recent history for context. Both the LLM and the lookups below
+    # use the last 3 messages; older turns in the window only reach the LLM
+    # as a one-line summary. The order/product lookups run after this read
+    # on purpose: which one to make is only known once the turn is routed,
+    # and a single AsyncSession cannot run statements concurrently.
+    history = await get_last_n_messages(session, user_id, HISTORY_WINDOW)
+    last_messages = history[:3]
 
     # Warranty safeguard
-    warranty_result = await handle_warranty_safeguard(user_id, user_message, last_messages)
+    warranty_result = await handle_warranty_safeguard(session, user_id, msg_lower, last_messages)
     if warranty_result == "ask_product":
         reply = "Produk mana yang ingin Anda ketahui informasi garansinya?"
-        await persist_message(user_id, "assistant", reply)
+        background.add_task(persist_message, user_id, "assistant", reply)
         return ChatResponse(reply=reply, tool_called=None, tool_output=None)
-    elif warranty_result:
-        action_json = warranty_result
 
-    # Fallback when LLM doesn't provide action
-    if not action_json or action_json.get("action") == "none":
-        patterns = await extract_patterns(user_message)
-        action_json = determine_fallback_action(user_message, patterns)
+    # Deterministic routing: an explicit ID or an unambiguous keyword plus
+    # product picks the tool on its own, so the LLM is only asked otherwise
+    action_json = warranty_result
+    if not action_json:
+        patterns = await extract_patterns(msg_lower)
+        action_json = determine_fallback_action(msg_lower, patterns)
+
+    llm_text = ""
+    if not action_json:
+        # Ask LLM
+        try:
+            llm_text = await collect_llm_reply(last_messages, user_message, summarize_turns(history[3:]))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"LLM error: {e}")
+
+        action_json = try_parse_json_action(llm_text)
 
     # Execute tools
+    pending_writes = []
     tool_called = None
     tool_output = None
     assistant_reply = llm_text
@@ -224,32 +359,20 @@ async def chat(req: ChatRequest):
         tool_called = action
 
         if action == "get_order_status":
-            async with AsyncSessionLocal() as session:
-                order_id = action_input.strip()
-
-                if not order_id:
-                    # Look for order in history or get latest
-                    history_orders = [re.search(r"(ORD\d+)", m["content"]) for m in last_messages]
-                    last_order_id = next((h.group(1) for h in history_orders if h), None)
-
-                    if last_order_id:
-                        tool_output = await get_user_order_status(session, user_id, last_order_id)
-                    else:
-                        latest_order = await get_latest_order_for_user(session, user_id)
-                        if latest_order:
-                            tool_output = {
-                                "found": True,
-                                "order_id": latest_order.order_id,
-                                "status": latest_order.status,
-                                "tracking": latest_order.tracking,
-                                "user_id": latest_order.user_id,
-                                "product_id": latest_order.product.id if latest_order.product else None,
-                                "product_name": latest_order.product.name if latest_order.product else None,
-                            }
-                        else:
-                            tool_output = {"found": False, "order_id": None}
+            order_id = action_input.strip()
+
+            if not order_id:
+                # Look for order in history or get latest
+                history_orders = (ORDER_ID_RE.search(m["content"].lower()) for m in last_messages)
+                last_order_id = next((h.group(1).upper() for h in history_orders if h), None)
+
+                if last_order_id:
+                    tool_output = await get_user_order_status(session, user_id, last_order_id)
                 else:
-                    tool_output = await get_user_order_status(session, user_id, order_id)
+                    latest_order = await get_latest_order_for_user(session, user_id)
+                    tool_output = latest_order or {"found": False, "order_id": None}
+            else:
+                tool_output = await get_user_order_status(session, user_id, order_id)
 
             if tool_output.get("found"):
                 assistant_reply = (
@@ -260,8 +383,7 @@ async def chat(req: ChatRequest):
                 assistant_reply = "Anda tidak memiliki pesanan dengan nomor tersebut."
 
         elif action == "get_warranty_info":
-            async with AsyncSessionLocal() as session:
-                tool_output = await get_warranty_info(session, action_input)
+            tool_output = await get_warranty_info(session, action_input)
             if tool_output:
                 assistant_reply = (
                     "Anda dapat mengklaim garansi dengan mengirim email ke warranty@company.com. "
@@ -273,17 +395,39 @@ async def chat(req: ChatRequest):
             else:
                 assistant_reply = f"Maaf — saya tidak dapat menemukan informasi garansi untuk produk {action_input}."
 
+        elif action == "get_order_bundle":
+            order_id = action_input.strip()
+            if not order_id:
+                latest_order = await get_latest_order_for_user(session, user_id)
+                order_id = latest_order["order_id"] if latest_order else ""
+            tool_output = await get_order_bundle(session, user_id, order_id)
+
+            if tool_output.get("found"):
+                order = tool_output["order"]
+                assistant_reply = (
+                    f"Pesanan {order['order_id']} saat ini berstatus: {order['status']}."
+                    + (f" Tracking: {order['tracking']}." if order.get("tracking") else "")
+                )
+                if tool_output["warranty"]:
+                    assistant_reply += (
+                        f"\n\nProduk {tool_output['product']['name']} memiliki garansi selama "
+                        f"{tool_output['warranty']['duration_months']} bulan. "
+                        f"Ketentuan: {tool_output['warranty']['terms']}"
+                    )
+            else:
+                assistant_reply = "Anda tidak memiliki pesanan dengan nomor tersebut."
+
         elif action == "get_product_info":
-            async with AsyncSessionLocal() as session:
-                tool_output = await get_product_info(session, action_input)
+            tool_output = await get_product_info(session, action_input)
 
             if tool_output:
-                msg_lower = user_message.lower()
-                if re.search(r"\b(kelebihan|keunggulan|pros|advantage)\b", msg_lower):
+                intent_match = PRODUCT_INTENT_RE.search(msg_lower)
+                intent = intent_match.lastgroup if intent_match else None
+                if intent == "pros":
                     assistant_reply = f"Kelebihan {tool_output['name']}: {tool_output.get('pros','Tidak tersedia')}"
-                elif re.search(r"\b(kekurangan|kelemahan|cons|disadvantage)\b", msg_lower):
+                elif intent == "cons":
                     assistant_reply = f"Kekurangan {tool_output['name']}: {tool_output.get('cons','Tidak tersedia')}"
-                elif re.search(r"\b(deskripsi|description|detail|tentang|about)\b", msg_lower):
+                elif intent == "desc":
                     assistant_reply = f"Deskripsi {tool_output['name']}: {tool_output['description']}"
                 else:
                     assistant_reply = (
@@ -300,10 +444,11 @@ async def chat(req: ChatRequest):
             tool_output = {"error": "unsupported_tool"}
 
         # Persist tool output
-        await persist_message(user_id, "tool", json.dumps({"tool": action, "output": tool_output}))
+        pending_writes.append(("tool", orjson.dumps({"tool": action, "output": tool_output}).decode()))
 
     # Persist assistant reply
-    await persist_message(user_id, "assistant", assistant_reply)
+    pending_writes.append(("assistant", assistant_reply))
+    background.add_task(persist_messages, user_id, pending_writes)
 
     return ChatResponse(reply=assistant_reply, tool_called=tool_called, tool_output=tool_output)
 
@@ -311,17 +456,13 @@ async def chat(req: ChatRequest):
 async def clear_database():
     """Clear all data from the database (dangerous operation)."""
     try:
-        async with AsyncSessionLocal() as session:
-            await session.execute(sqlalchemy.text("DELETE FROM messages"))
-            await session.execute(sqlalchemy.text("DELETE FROM orders"))  
-            await session.execute(sqlalchemy.text("DELETE FROM products"))
-            await session.execute(sqlalchemy.text("DELETE FROM warranties"))
-            await session.commit()
-            
-            global _product_patterns_cache, _cache_timestamp
-            _product_patterns_cache = None
-            _cache_timestamp = None
-            
+        await clear_tables()
+        
+        global _patterns_entry
+        _patterns_entry = None
+        _response_cache.clear()
+        invalidate_caches()
+        
         return {"message": "Database cleared successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing database: {e}")
@@ -332,9 +473,10 @@ async def seed_database_endpoint():
     try:
         await seed_database()
         
-        global _product_patterns_cache, _cache_timestamp
-        _product_patterns_cache = None
-        _cache_timestamp = None
+        global _patterns_entry
+        _patterns_entry = None
+        _response_cache.clear()
+        invalidate_caches()
         
         return {"message": "Database seeded successfully"}
     except Exception as e:
@@ -344,18 +486,13 @@ async def seed_database_endpoint():
 async def reset_database():
     """Clear and reseed the database (full reset)."""
     try:
-        async with AsyncSessionLocal() as session:
-            await session.execute(sqlalchemy.text("DELETE FROM messages"))
-            await session.execute(sqlalchemy.text("DELETE FROM orders"))
-            await session.execute(sqlalchemy.text("DELETE FROM products"))
-            await session.execute(sqlalchemy.text("DELETE FROM warranties"))
-            await session.commit()
-        
+        await clear_tables()
         await seed_database()
         
-        global _product_patterns_cache, _cache_timestamp
-        _product_patterns_cache = None
-        _cache_timestamp = None
+        global _patterns_entry
+        _patterns_entry = None
+        _response_cache.clear()
+        invalidate_caches()
         
         return {"message": "Database reset successfully (cleared and reseeded)"}
     except Exception as e:
@@ -366,61 +503,64 @@ async def database_status():
     """Get database status and record counts."""
     try:
         async with AsyncSessionLocal() as session:
-            # Count records in each table
-            message_count = await session.execute(sqlalchemy.text("SELECT COUNT(*) FROM messages"))
-            order_count = await session.execute(sqlalchemy.text("SELECT COUNT(*) FROM orders"))
-            product_count = await session.execute(sqlalchemy.text("SELECT COUNT(*) FROM products"))
-            warranty_count = await session.execute(sqlalchemy.text("SELECT COUNT(*) FROM warranties"))
+            # Count records in each table, in one round trip
+            counts = await session.execute(sqlalchemy.text(
+                "SELECT (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM orders), "
+                "(SELECT COUNT(*) FROM products), (SELECT COUNT(*) FROM warranties)"
+            ))
+            message_count, order_count, product_count, warranty_count = counts.one()
             
             return {
                 "status": "connected",
                 "tables": {
-                    "messages": message_count.scalar(),
-                    "orders": order_count.scalar(),
-                    "products": product_count.scalar(),
-                    "warranties": warranty_count.scalar()
+                    "messages": message_count,
+                    "orders": order_count,
+                    "products": product_count,
+                    "warranties": warranty_count
                 },
                 "cache_status": {
-                    "patterns_cached": _product_patterns_cache is not None,
-                    "cache_age_seconds": int(time.time() - _cache_timestamp) if _cache_timestamp else None
+                    "patterns_cached": _patterns_entry is not None,
+                    "cache_age_seconds": (
+                        int(time.monotonic() - _patterns_entry[0] + PATTERNS_CACHE_TTL)
+                        if _patterns_entry else None
+                    )
                 }
             }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error checking database status: {e}")
 
 @app.get("/history/{user_id}")
-async def history(user_id: str):
+async def history(user_id: str, session: AsyncSession = Depends(get_session)):
     """Get conversation history for a user."""
-    return await get_all_messages_for_user(user_id)
+    return await get_all_messages_for_user(session, user_id)
 
 @app.get("/order/{order_id}")
-async def order_status_endpoint(order_id: str):
+async def order_status_endpoint(order_id: str, session: AsyncSession = Depends(get_session)):
     """Get order status by order ID."""
-    data = await get_order_status(order_id)
+    data = await get_order_status(session, order_id)
     if not data.get("found"):
         raise HTTPException(status_code=404, detail=f"Order {order_id} not found")
     return data
 
 @app.get("/users/{user_id}/orders")
-async def user_orders(user_id: str):
+async def user_orders(user_id: str, session: AsyncSession = Depends(get_session)):
     """Get all orders for a specific user."""
-    return await get_all_orders_for_user(user_id)
+    return await get_all_orders_for_user(session, user_id)
 
 @app.get("/products/{product_id}")
-async def get_product_endpoint(product_id: str):
+async def get_product_endpoint(product_id: str, session: AsyncSession = Depends(get_session)):
     """Get product information by product ID."""
-    async with AsyncSessionLocal() as session:
-        product_info = await get_product_info(session, product_id)
-        if not product_info:
-            raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
-        return product_info
+    product_info = await get_product_info(session, product_id)
+    if not product_info:
+        raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+    return product_info
 
 @app.get("/products")
-async def list_products():
+async def list_products(session: AsyncSession = Depends(get_session)):
     """List all products."""
-    return await get_all_products()
+    return await get_all_products(session)
 
 @app.get("/warranties")
-async def list_warranties():
+async def list_warranties(session: AsyncSession = Depends(get_session)):
     """List all warranty policies."""
-    return await get_all_warranties()
\ No newline at end of file
+    return await get_all_warranties(session)
\ No newline at end of file